@@ -1,33 +1,128 @@
 import os
 import json
+import hashlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
 import time
-from app.services.heading_detector import process_pdf_for_headings
+from typing import Iterable, Iterator, Optional, Tuple
+import fitz  # PyMuPDF
+from app.models.documents import Heading
+from app.services.heading_detector import HeadingDetector, warm_up
+
+CACHE_DIR = Path("/app/cache")
+# Bump whenever the detection heuristics or the output schema change,
+# so stale cache entries are never served for a new version.
+CACHE_VERSION = b"1"
+
+def _cache_key(pdf_path: Path) -> str:
+    """
+    SHA-256 over the length-prefixed cache version, PyMuPDF version and PDF
+    bytes. The PyMuPDF version is included because upgrading it can change
+    text extraction, and with it the detected headings.
+    """
+    digest = hashlib.sha256()
+    for part in (CACHE_VERSION, fitz.VersionBind.encode()):
+        digest.update(len(part).to_bytes(8, "big"))
+        digest.update(part)
+    # Hash the file in chunks so it is never held in memory as a whole
+    with open(pdf_path, "rb") as f:
+        digest.update(os.fstat(f.fileno()).st_size.to_bytes(8, "big"))
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def _write_atomic(path: Path, chunks: Iterable[str]):
+    """Writes text chunks to a temporary sibling file and renames it into place."""
+    tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    try:
+        with open(tmp_path, "w", encoding='utf-8') as f:
+            f.writelines(chunks)
+        os.replace(tmp_path, path)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+
+def _copy_atomic(src: Path, dst: Path):
+    with open(src, encoding='utf-8') as f:
+        _write_atomic(dst, f)
+
+def _iter_document_json(title: Optional[str], headings: Iterable[Heading]) -> Iterator[str]:
+    """
+    Yields the document JSON piece by piece, one heading at a time, so the
+    outline is never held in memory. The output is byte-for-byte what
+    DocumentStructure.model_dump_json(exclude_none=True, indent=4) produces.
+    """
+    yield "{\n"
+    if title is not None:
+        yield f'    "title": {json.dumps(title, ensure_ascii=False)},\n'
+    yield '    "outline": ['
+    separator = "\n"
+    for heading in headings:
+        yield separator
+        # JSON strings never contain raw newlines, so re-indenting is safe
+        yield "        " + heading.model_dump_json(indent=4).replace("\n", "\n        ")
+        separator = ",\n"
+    if separator != "\n":
+        yield "\n    "
+    yield "]\n}"
+
+def _process_single_pdf(pdf_path: Path, output_path: Path, cache_dir: Optional[Path]) -> Tuple[float, bool]:
+    """
+    Runs heading detection for one PDF inside a worker process and streams
+    the result to output_path. Returns the duration and whether the cache hit.
+    The cache is optional: cache_dir is None when it is unavailable, and any
+    failure to read or write an entry falls back to uncached processing.
+    """
+    start_time = time.time()
+    cache_path = cache_dir / f"{_cache_key(pdf_path)}.json" if cache_dir else None
+    if cache_path:
+        try:
+            if cache_path.is_file():
+                _copy_atomic(cache_path, output_path)
+                return time.time() - start_time, True
+        except (OSError, UnicodeError) as e:
+            print(f"WARNING: Could not read cached result for {pdf_path.name}: {e}")
+
+    with HeadingDetector(pdf_path) as detector:
+        _write_atomic(output_path, _iter_document_json(detector.title, detector.iter_headings()))
+    if cache_path:
+        try:
+            _copy_atomic(output_path, cache_path)
+        except OSError as e:
+            print(f"WARNING: Could not cache result for {pdf_path.name}: {e}")
+    return time.time() - start_time, False
 
 def run_batch_processing():
     input_dir = Path("/app/input")
     output_dir = Path("/app/output")
     output_dir.mkdir(exist_ok=True)
+    cache_dir = CACHE_DIR
+    try:
+        cache_dir.mkdir(parents=True, exist_ok=True)
+    except OSError as e:
+        # The cache is optional; turn it off for this run and process uncached
+        print(f"WARNING: Could not create cache directory {CACHE_DIR}, caching disabled: {e}")
+        cache_dir = None
     pdf_files = list(input_dir.glob("*.pdf"))
     if not pdf_files:
         print("No PDF files found in /app/input")
         return
     print(f"Found {len(pdf_files)} PDF(s) to process.")
-    for pdf_path in pdf_files:
-        start_time = time.time()
-        print(f"Processing {pdf_path.name}...")
-        try:
-            with open(pdf_path, "rb") as f:
-                pdf_bytes = f.read()
-            document_structure = process_pdf_for_headings(pdf_bytes)
-            result_json_dict = document_structure.model_dump(exclude_none=True)
-            output_filename = output_dir / f"{pdf_path.stem}.json"
-            with open(output_filename, "w", encoding='utf-8') as f:
-                json.dump(result_json_dict, f, indent=4, ensure_ascii=False)
-            duration = time.time() - start_time
-            print(f"Successfully generated {output_filename.name} in {duration:.2f} seconds.")
-        except Exception as e:
-            print(f"ERROR: Failed to process {pdf_path.name}: {e}")
+    # Parsing is CPU-bound, so each PDF gets its own worker process (and GIL).
+    # Workers stream their JSON straight to disk; only timings come back here.
+    max_workers = min(os.cpu_count() or 1, len(pdf_files))
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=warm_up) as executor:
+        futures = {
+            executor.submit(_process_single_pdf, pdf_path, output_dir / f"{pdf_path.stem}.json", cache_dir): pdf_path
+            for pdf_path in pdf_files
+        }
+        for future in as_completed(futures):
+            pdf_path = futures[future]
+            try:
+                duration, cache_hit = future.result()
+                source = " (cached)" if cache_hit else ""
+                print(f"Successfully generated {pdf_path.stem}.json{source} in {duration:.2f} seconds.")
+            except Exception as e:
+                print(f"ERROR: Failed to process {pdf_path.name}: {e}")
 
 if __name__ == "__main__":
     print("--- Starting PDF Structure Extraction (Challenge 1A) ---")
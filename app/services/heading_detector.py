@@ -1,7 +1,10 @@
 import fitz  # PyMuPDF
 import re
+from array import array
 from collections import Counter
-from typing import List, Dict, Any, Optional
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple, Union
 
 from app.models.documents import DocumentStructure, Heading
 
@@ -10,80 +13,160 @@ from app.models.documents import DocumentStructure, Heading
 BODY_SIZE_THRESHOLD_RATIO = 1.15 # Lowered threshold to catch more potential headings
 H1_THRESHOLD_RATIO = 1.6
 H2_THRESHOLD_RATIO = 1.3
+# The body size estimate converges quickly, so at most this many evenly
+# spaced pages are decoded up front to compute it
+BODY_SIZE_SAMPLE_PAGES = 50
 
 # Regular expression to detect numeric prefixes like "1.", "2.1", "3.1.4"
 NUMERIC_PREFIX_RE = re.compile(r'^\s*(\d+(\.\d+)*)\s+')
 
+@dataclass
+class TextLines:
+    """
+    A collection of non-empty text lines, stored column-wise.
+    Only the first span of each line is consulted, so its font, size and
+    flags are kept instead of the full span list.
+    """
+    text: List[str] = field(default_factory=list)
+    font: List[str] = field(default_factory=list)
+    size: array = field(default_factory=lambda: array('d'))
+    flags: array = field(default_factory=lambda: array('i'))
+    bbox: List[Tuple[float, float, float, float]] = field(default_factory=list)
+
+    def __len__(self) -> int:
+        return len(self.text)
+
+    def append(self, text: str, font: str, size: float, flags: int,
+               bbox: Tuple[float, float, float, float]):
+        self.text.append(text)
+        self.font.append(font)
+        self.size.append(size)
+        self.flags.append(flags)
+        self.bbox.append(bbox)
+
 class HeadingDetector:
     """
     Analyzes a PDF to extract its title and hierarchical headings (H1, H2, H3).
     This version includes more advanced heuristics for structural analysis.
     """
 
-    def __init__(self, pdf_bytes: bytes):
-        self.doc = fitz.open(stream=pdf_bytes, filetype="pdf")
-        self._all_spans = self._get_all_spans()
-        self.body_size = self._calculate_body_size()
-        self.title = self._find_title()
-
-    def _get_all_spans(self) -> List[Dict[str, Any]]:
-        """Extract all text spans from all pages with page numbers."""
-        all_spans = []
-        for page_num, page in enumerate(self.doc, 1):
-            # Using 'blocks' gives better structural separation than 'spans' alone
-            blocks = page.get_text("dict", flags=fitz.TEXTFLAGS_SEARCH)["blocks"]
-            for block in blocks:
-                if block["type"] == 0:  # Text block
-                    for line in block["lines"]:
-                        # Clean up line text
-                        line_text = "".join(s["text"] for s in line["spans"]).strip()
-                        if not line_text:
-                            continue
-                        
-                        # Store line-level information
-                        line_info = {
-                            "text": line_text,
-                            "spans": line["spans"],
-                            "bbox": line["bbox"],
-                            "page_num": page_num
-                        }
-                        all_spans.append(line_info)
-        return all_spans
+    def __init__(self, pdf_source: Union[bytes, str, Path]):
+        if isinstance(pdf_source, bytes):
+            self.doc = fitz.open(stream=pdf_source, filetype="pdf")
+        else:
+            # Opening by path lets MuPDF read the file itself instead of
+            # holding a second, in-memory copy of it
+            self.doc = fitz.open(str(pdf_source), filetype="pdf")
+        # Documents use only a handful of distinct fonts, so remember per font
+        # name whether it is a bold face instead of lowercasing it on every line.
+        self._bold_font_cache: Dict[str, bool] = {}
+        self._size_counts = Counter()
+        self._first_page_lines = TextLines()
+        # Possible headings from the pages decoded during sampling, by page number
+        self._sampled_candidates: Dict[int, TextLines] = {}
+        try:
+            self._sample_pages()
+            self.body_size = self._calculate_body_size()
+            # Absolute size thresholds, so classification compares sizes directly
+            self._min_significant_size = self.body_size * BODY_SIZE_THRESHOLD_RATIO
+            self._min_h1_size = self.body_size * H1_THRESHOLD_RATIO
+            self._min_h2_size = self.body_size * H2_THRESHOLD_RATIO
+            self.title = self._find_title()
+        except BaseException:
+            # __exit__ never runs if the constructor fails, so close here
+            self.doc.close()
+            raise
+
+    def __enter__(self) -> "HeadingDetector":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.doc.close()
+
+    @staticmethod
+    def _iter_page_lines(page: fitz.Page) -> Iterator[Tuple[str, str, float, int, Tuple[float, float, float, float]]]:
+        """
+        Yields (text, font, size, flags, bbox) for every non-empty text line on
+        a page. Font, size and flags are taken from the line's first span; the
+        remaining spans only contribute their text.
+        """
+        # Using 'blocks' gives better structural separation than 'spans' alone
+        blocks = page.get_text("dict", flags=fitz.TEXTFLAGS_SEARCH)["blocks"]
+        for block in blocks:
+            if block["type"] == 0:  # Text block
+                for line in block["lines"]:
+                    # Clean up line text
+                    spans = line["spans"]
+                    line_text = "".join(s["text"] for s in spans).strip()
+                    if not line_text:
+                        continue
+                    first_span = spans[0]
+                    yield line_text, first_span["font"], first_span["size"], first_span["flags"], line["bbox"]
+
+    @staticmethod
+    def _may_be_heading(text: str, bbox: Tuple[float, float, float, float]) -> bool:
+        """
+        Cheap pre-filter that is independent of the body size: a line can only
+        become a heading through a numeric prefix, or by being short and
+        outside the header/footer bands (see _get_heading_level).
+        """
+        if text[0].isdecimal() and NUMERIC_PREFIX_RE.match(text):
+            return True
+        # Position checks first: they are free, while splitting allocates
+        return bbox[1] > 50 and bbox[3] < 750 and len(text.split()) < 12
+
+    def _read_sample_page(self, page_num: int) -> TextLines:
+        """
+        Decodes a single sampled page (1-based) into the size histogram and,
+        for page one, the title lines. Returns only its possible headings.
+        """
+        candidates = TextLines()
+        for line in self._iter_page_lines(self.doc[page_num - 1]):
+            line_text, _, size, _, bbox = line
+            # Consider only the font sizes of the first span of each line
+            self._size_counts[round(size)] += 1
+            if page_num == 1:
+                self._first_page_lines.append(*line)
+            if self._may_be_heading(line_text, bbox):
+                candidates.append(*line)
+        return candidates
+
+    def _sample_pages(self):
+        """
+        Decodes page one and up to BODY_SIZE_SAMPLE_PAGES evenly spaced pages
+        for the title and body size. Their candidates are kept so iter_headings
+        never decodes a page twice; all other pages are only read there.
+        """
+        page_count = self.doc.page_count
+        sample_count = min(BODY_SIZE_SAMPLE_PAGES, page_count)
+        for i in range(sample_count):
+            page_num = i * page_count // sample_count + 1
+            self._sampled_candidates[page_num] = self._read_sample_page(page_num)
 
     def _calculate_body_size(self) -> float:
         """Calculates the most common font size to use as a proxy for the body text size."""
-        if not self._all_spans:
-            return 12.0
-
-        # Consider only the font sizes of the first span of each line
-        sizes = [round(line["spans"][0]["size"]) for line in self._all_spans if line["spans"]]
-        if not sizes:
+        if not self._size_counts:
             return 12.0
 
-        return Counter(sizes).most_common(1)[0][0]
+        return self._size_counts.most_common(1)[0][0]
 
     def _find_title(self) -> Optional[str]:
         """
         Finds the document title by concatenating all text on the first page
         that has the largest font size.
         """
-        max_size = 0
         # Search only the first page for the title
-        lines_on_first_page = [line for line in self._all_spans if line["page_num"] == 1 and line["spans"]]
-
-        if not lines_on_first_page:
+        lines = self._first_page_lines
+        if not lines:
             return None
 
         # Find the maximum font size on the first page
-        for line in lines_on_first_page:
-            size = line["spans"][0]["size"]
-            if size > max_size:
-                max_size = size
-        
+        max_size = max(lines.size)
+
         # Collect all lines with that max font size
         title_parts = [
-            line["text"] for line in lines_on_first_page
-            if abs(line["spans"][0]["size"] - max_size) < 0.1 # Use a small tolerance
+            text for text, size in zip(lines.text, lines.size)
+            if abs(size - max_size) < 0.1 # Use a small tolerance
         ]
         
         title = " ".join(title_parts).strip()
@@ -93,18 +176,21 @@ class HeadingDetector:
              return title
         return None
 
-    def _get_heading_level(self, line: Dict[str, Any]) -> Optional[str]:
+    def _get_heading_level(self, text: str, font: str, size: float, flags: int,
+                           bbox: Tuple[float, float, float, float]) -> Optional[str]:
         """
-        Determines the heading level (H1, H2, H3) using a combination of
-        numeric prefixes and font styles. Returns None if not a heading.
+        Determines the heading level (H1, H2, H3) of a line using a combination
+        of numeric prefixes and font styles. Returns None if not a heading.
         """
-        text = line["text"]
-        first_span = line["spans"][0]
-        size = first_span["size"]
-        is_bold = "bold" in first_span["font"].lower() or (first_span["flags"] & 2**4)
+        is_bold_font = self._bold_font_cache.get(font)
+        if is_bold_font is None:
+            is_bold_font = self._bold_font_cache[font] = "bold" in font.lower()
+        is_bold = is_bold_font or (flags & 2**4)
 
         # --- Rule 1: Structural Analysis (High Priority) ---
-        match = NUMERIC_PREFIX_RE.match(text)
+        # Lines are stripped, so a numeric prefix can only start at a digit;
+        # this check keeps the regex off the vast majority of lines.
+        match = text[0].isdecimal() and NUMERIC_PREFIX_RE.match(text)
         if match:
             prefix = match.group(1)
             # Count the dots to determine hierarchy level
@@ -115,47 +201,74 @@ class HeadingDetector:
 
         # --- Rule 2: Stylistic Analysis (Fallback) ---
         # Must be bold or significantly larger than body text
-        is_stylistically_significant = is_bold or size > (self.body_size * BODY_SIZE_THRESHOLD_RATIO)
-        is_short = len(text.split()) < 12 # Headings are usually short
-        
-        # Avoid classifying headers/footers
-        is_likely_content = line["bbox"][1] > 50 and line["bbox"][3] < 750
+        is_stylistically_significant = is_bold or size > self._min_significant_size
+        if not is_stylistically_significant:
+            return None
 
-        if is_stylistically_significant and is_short and is_likely_content:
-            rel_size = size / self.body_size
-            if rel_size > H1_THRESHOLD_RATIO: return "H1"
-            if rel_size > H2_THRESHOLD_RATIO: return "H2"
+        # Avoid classifying headers/footers
+        is_likely_content = bbox[1] > 50 and bbox[3] < 750
+        # Headings are usually short; checked last since splitting allocates
+        if is_likely_content and len(text.split()) < 12:
+            if size > self._min_h1_size: return "H1"
+            if size > self._min_h2_size: return "H2"
             # If it's just bold but not much larger, classify as H3
             if is_bold: return "H3"
 
         return None
 
-    def extract_structure(self) -> DocumentStructure:
-        """
-        Orchestrates the heading extraction process and returns the final structure.
-        """
-        outline = []
+    def iter_headings(self) -> Iterator[Heading]:
+        """Yields the detected headings in document order."""
+        # Keyed on the line bbox, which also drops running headers that repeat
+        # at the same position on every page.
         processed_lines = set()
+        title = self.title
+
+        # Pages are walked serially on purpose: PyMuPDF documents are not
+        # thread-safe, so parallelism lives at the batch level (one process per PDF).
+        for page_num in range(1, self.doc.page_count + 1):
+            lines = self._sampled_candidates.pop(page_num, None)
+            if lines is None:
+                # The body size is known by now, so pages outside the sample are
+                # classified straight off the decoder without storing any lines
+                page_lines = self._iter_page_lines(self.doc[page_num - 1])
+            else:
+                # Walk the columns in lockstep rather than materializing a record per line
+                page_lines = zip(lines.text, lines.font, lines.size, lines.flags, lines.bbox)
 
-        for line in self._all_spans:
-            line_text = line["text"]
-            line_bbox_tuple = tuple(line['bbox'])
-            page_num = line["page_num"]
+            for line_text, font, size, flags, bbox in page_lines:
+                # Avoid reprocessing the title (stored lines are never empty)
+                if line_text == title:
+                    continue
 
-            # Avoid reprocessing the same line or the title
-            if not line_text or line_bbox_tuple in processed_lines or line_text == self.title:
-                continue
+                # Classify before the set lookup so only headings get their bbox
+                # hashed; MuPDF already hands out bboxes as tuples.
+                level = self._get_heading_level(line_text, font, size, flags, bbox)
+                if level and bbox not in processed_lines:
+                    yield Heading(level=level, text=line_text, page=page_num)
+                    processed_lines.add(bbox)
 
-            level = self._get_heading_level(line)
-            if level:
-                outline.append(
-                    Heading(level=level, text=line_text, page=page_num)
-                )
-                processed_lines.add(line_bbox_tuple)
+    def extract_structure(self) -> DocumentStructure:
+        """
+        Orchestrates the heading extraction process and returns the final structure.
+        """
+        # The headings are already validated models, so don't re-validate the wrapper
+        return DocumentStructure.model_construct(title=self.title, outline=list(self.iter_headings()))
 
-        return DocumentStructure(title=self.title, outline=outline)
+def warm_up():
+    """
+    Pays MuPDF's one-time setup cost (loading the built-in font and text
+    extraction machinery) by extracting text from a tiny in-memory PDF.
+    Meant to run as a worker-process initializer, before the first real PDF.
+    """
+    with fitz.open() as doc:
+        page = doc.new_page()
+        page.insert_text((72, 72), "1 Warm-up")
+        page.get_text("dict", flags=fitz.TEXTFLAGS_SEARCH)
 
-def process_pdf_for_headings(pdf_bytes: bytes) -> DocumentStructure:
-    """High-level function to process a PDF and return its structure."""
-    detector = HeadingDetector(pdf_bytes)
-    return detector.extract_structure()
+def process_pdf_for_headings(pdf_source: Union[bytes, str, Path]) -> DocumentStructure:
+    """
+    High-level function to process a PDF, given as a file path or its raw
+    bytes, and return its structure.
+    """
+    with HeadingDetector(pdf_source) as detector:
+        return detector.extract_structure()